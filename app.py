@@ -13,6 +13,18 @@ import pytz
 import google.generativeai as genai
 import twstock
 import time
+import threading
+import os
+import random
+import pickle
+import sys
+import math
+import hmac
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+from streamlit.runtime.scriptrunner import get_script_run_ctx
 
 # --- Optional: News Search Module ---
 try:
@@ -34,6 +46,94 @@ def get_yfinance_suffix(ticker):
     except:
         return ".TW"
 
+# V17: Per-Rerun Profiler (admin, one script execution at a time, off by default)
+PROFILE_INTERVAL = 0.002  # seconds between stack samples of the script thread
+
+class RerunSampler:
+    def __init__(self, thread_id):
+        self.thread_id = thread_id
+        self.samples = []  # (perf_counter, stack of (name, file, line) from root to leaf)
+        self.running = True
+        self.started = time.perf_counter()
+        self.stopped = None
+        self.thread = threading.Thread(target=self._sample_loop, name="rerun-sampler", daemon=True)
+        self.thread.start()
+
+    def _sample_loop(self):
+        while self.running:
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append((code.co_name, code.co_filename, code.co_firstlineno))
+                frame = frame.f_back
+            self.samples.append((time.perf_counter(), tuple(reversed(stack))))
+            time.sleep(PROFILE_INTERVAL)
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+        self.stopped = time.perf_counter()
+
+    def report(self):
+        frames, frame_index = [], {}
+        stacks, weights = [], []
+        self_ms, total_ms = {}, {}
+        next_times = [t for t, _ in self.samples[1:]] + [self.stopped]
+        for (t, stack), t_next in zip(self.samples, next_times):
+            weight = (t_next - t) * 1000
+            for f in stack:
+                if f not in frame_index:
+                    frame_index[f] = len(frames)
+                    frames.append({'name': f[0], 'file': f[1], 'line': f[2]})
+            stacks.append([frame_index[f] for f in stack])
+            weights.append(weight)
+            for f in set(stack):
+                total_ms[f] = total_ms.get(f, 0) + weight
+            if stack:
+                self_ms[stack[-1]] = self_ms.get(stack[-1], 0) + weight
+
+        elapsed_ms = (self.stopped - self.started) * 1000
+        hot = pd.DataFrame([
+            {'function': f[0], 'location': f"{os.path.basename(f[1])}:{f[2]}",
+             'self_ms': round(self_ms.get(f, 0), 1), 'total_ms': round(total_ms[f], 1)}
+            for f in total_ms
+        ], columns=['function', 'location', 'self_ms', 'total_ms'])
+        hot = hot.sort_values('self_ms', ascending=False).head(20).reset_index(drop=True)
+
+        speedscope = {
+            '$schema': 'https://www.speedscope.app/file-format-schema.json',
+            'name': 'app.py rerun',
+            'exporter': 'sniper-dashboard',
+            'shared': {'frames': frames},
+            'profiles': [{
+                'type': 'sampled', 'name': 'app.py rerun', 'unit': 'milliseconds',
+                'startValue': 0, 'endValue': elapsed_ms, 'samples': stacks, 'weights': weights,
+            }],
+        }
+        return {'elapsed_ms': elapsed_ms, 'samples': len(stacks), 'hot': hot, 'speedscope': json.dumps(speedscope)}
+
+def is_admin():
+    # ?admin=<ADMIN_TOKEN from secrets>; without a configured token nobody is admin
+    token = st.secrets["ADMIN_TOKEN"] if "ADMIN_TOKEN" in st.secrets else None
+    given = st.query_params.get("admin")
+    return bool(token) and given is not None and hmac.compare_digest(str(given), str(token))
+
+def start_rerun_profile():
+    finish_rerun_profile()  # the previous profiled run ended early through st.rerun()
+    if st.session_state.get('profile_requested'):
+        st.session_state.profile_requested = False
+        st.session_state.active_sampler = RerunSampler(threading.get_ident())
+
+def finish_rerun_profile():
+    sampler = st.session_state.get('active_sampler')
+    if sampler is None: return
+    st.session_state.active_sampler = None
+    sampler.stop()
+    st.session_state.profile_result = sampler.report()
+
+start_rerun_profile()
+
 # --- 2. Page Config ---
 st.set_page_config(
     page_title="Sniper V17 Royal",
@@ -172,54 +272,352 @@ def get_positions():
     except Exception as e:
         return []
 
-# V13: Daily Technical Data
-def get_technical_data(ticker):
-    try:
-        suffix = get_yfinance_suffix(ticker)
-        stock = yf.Ticker(ticker + suffix)
-        df = stock.history(period="1y")
-        
-        if df.empty and suffix == ".TW":
-            stock = yf.Ticker(ticker + ".TWO")
-            df = stock.history(period="1y")
+# V17: Provider Layer (timeouts, hedged .TW/.TWO requests, jittered retries, circuit breakers)
+PROVIDER_TIMEOUT = 8     # socket timeout handed to clients that accept one (yfinance, DDGS)
+PROVIDER_DEADLINE = 10   # seconds one call may take in total, retries and backoff included
+PROVIDER_RETRIES = 2     # extra attempts after the first, only while the deadline allows
+SNIPER_DEADLINE = 12     # seconds for every provider call of one Sniper rerun together
+PROVIDER_BACKOFF = 0.5   # seconds, base of the full-jitter exponential backoff
+HEDGE_DELAY = 0.5        # seconds before the alternate .TW/.TWO request is fired
+BREAKER_THRESHOLD = 3    # consecutive failed calls before a provider's breaker opens
+BREAKER_COOLDOWN = 60    # seconds an open breaker serves last good data instead of calling out
+LAST_GOOD_SIZE = 256     # last good responses kept for fallback (LRU)
+LAST_GOOD_MAX_AGE = 3600 # seconds before a last good response is too stale to serve
+
+@st.cache_resource
+def get_provider_state():
+    return {
+        'lock': threading.Lock(),
+        'breakers': {},
+        'last_good': OrderedDict(),  # key -> (value, stored_at)
+        'pool': ThreadPoolExecutor(max_workers=32, thread_name_prefix="provider"),
+        'hedge_pool': ThreadPoolExecutor(max_workers=16, thread_name_prefix="hedge"),
+    }
 
-        if df.empty: return None
-        
-        try: df.ta.macd(fast=12, slow=26, signal=9, append=True)
-        except: pass
-        try: df.ta.stoch(k=9, d=3, append=True)
-        except: pass
-        try: df.ta.rsi(length=14, append=True)
-        except: pass
-        try: df.ta.bbands(length=20, std=2, append=True)
-        except: pass
-        try: df.ta.obv(append=True)
-        except: pass
-        try: df.ta.mfi(length=14, append=True)
-        except: pass
+def remember_good(state, key, value):
+    # Caller holds state['lock']
+    state['last_good'][key] = (value, time.time())
+    state['last_good'].move_to_end(key)
+    while len(state['last_good']) > LAST_GOOD_SIZE:
+        state['last_good'].popitem(last=False)
+
+def recall_good(state, key, default=None):
+    # Caller holds state['lock']
+    entry = state['last_good'].get(key)
+    if entry is None: return default
+    if time.time() - entry[1] > LAST_GOOD_MAX_AGE:
+        del state['last_good'][key]
+        return default
+    state['last_good'].move_to_end(key)
+    return entry[0]
+
+def call_provider(provider, key, fetch, is_valid=lambda v: v is not None, retries=PROVIDER_RETRIES, deadline=None):
+    # deadline is an absolute time.time(); attempts and backoff never run past it.
+    # A timed-out fetch is abandoned, not cancelled: it keeps its pool worker until its own socket gives up.
+    state = get_provider_state()
+    if deadline is None: deadline = time.time() + PROVIDER_DEADLINE
+    with state['lock']:
+        breaker = state['breakers'].setdefault(provider, {'failures': 0, 'open_until': 0.0})
+        if breaker['open_until'] > time.time():
+            return recall_good(state, key)
+
+    for attempt in range(retries + 1):
+        if attempt:
+            time.sleep(min(random.uniform(0, PROVIDER_BACKOFF * 2 ** attempt), max(deadline - time.time(), 0)))
+        remaining = deadline - time.time()
+        if remaining <= 0: break
         try:
-            ma20 = df['Close'].rolling(20).mean()
-            df['BIAS_20'] = ((df['Close'] - ma20) / ma20) * 100
-        except: pass
+            value = state['pool'].submit(fetch).result(timeout=remaining)
+        except Exception:
+            continue
+        with state['lock']:
+            breaker['failures'] = 0
+            if is_valid(value):
+                remember_good(state, key, value)
+                return value
+            # Answered but empty (Yahoo often does this when flapping): prefer the last good copy
+            return recall_good(state, key, value)
+
+    with state['lock']:
+        breaker['failures'] += 1
+        if breaker['failures'] >= BREAKER_THRESHOLD:
+            breaker['open_until'] = time.time() + BREAKER_COOLDOWN
+        return recall_good(state, key)
+
+def hedged_yahoo(ticker, key, fetch_symbol, is_valid, deadline=None):
+    # The listed market's suffix goes first; the other one is raced against it after HEDGE_DELAY
+    primary = ticker + get_yfinance_suffix(ticker)
+    alternate = ticker + (".TWO" if primary.endswith(".TW") else ".TW")
+
+    def attempt(symbol):
+        return symbol, call_provider("yahoo", (*key, symbol), lambda: fetch_symbol(symbol), is_valid, deadline=deadline)
+
+    if deadline is None: deadline = time.time() + PROVIDER_DEADLINE
+    pool = get_provider_state()['hedge_pool']
+    futures = [pool.submit(attempt, primary)]
+    done, _ = wait(futures, timeout=HEDGE_DELAY)
+    if not (done and is_valid(futures[0].result()[1])):
+        futures.append(pool.submit(attempt, alternate))
+
+    fallback = None
+    for future in as_completed(futures):
+        symbol, value = future.result()
+        if is_valid(value): return symbol, value
+        if symbol == primary: fallback = value
+    return primary, fallback
+
+def has_rows(df):
+    return df is not None and not df.empty
+
+def fetch_symbol_history(symbol, period, interval="1d", deadline=None):
+    df = call_provider("yahoo", ("history", period, interval, symbol),
+                       lambda: yf.Ticker(symbol).history(period=period, interval=interval, timeout=PROVIDER_TIMEOUT),
+                       has_rows, deadline=deadline)
+    return df.copy() if has_rows(df) else None  # never hand out the shared last-good frame
+
+def fetch_yahoo_history(ticker, period, interval="1d", deadline=None):
+    symbol, df = hedged_yahoo(ticker, ("history", period, interval),
+                              lambda s: yf.Ticker(s).history(period=period, interval=interval, timeout=PROVIDER_TIMEOUT),
+                              has_rows, deadline=deadline)
+    return symbol, (df.copy() if has_rows(df) else None)
+
+# V13: Daily Technical Data (raw OHLCV; indicators are added per view by get_indicators)
+def get_technical_data(ticker):
+    try:
+        symbol, df = fetch_yahoo_history(ticker, "1y")
         return df
     except: return None
 
+# V17: Indicator Registry (each view declares what it needs; computed on first access,
+# memoized per ticker and last bar so reruns and other sessions reuse the result)
+INDICATOR_MEMO_SIZE = 512
+
+def compute_bias_20(df, ticker):
+    ma20 = get_indicator(df, ticker, 'MA20')
+    return (((df['Close'] - ma20) / ma20) * 100).rename('BIAS_20')
+
+INDICATOR_REGISTRY = {
+    'MACD': lambda df, ticker: df.ta.macd(fast=12, slow=26, signal=9),
+    'STOCH': lambda df, ticker: df.ta.stoch(k=9, d=3),
+    'RSI_14': lambda df, ticker: df.ta.rsi(length=14),
+    'BBANDS': lambda df, ticker: df.ta.bbands(length=20, std=2),
+    'OBV': lambda df, ticker: df.ta.obv(),
+    'MFI_14': lambda df, ticker: df.ta.mfi(length=14),
+    'MA20': lambda df, ticker: df['Close'].rolling(20).mean().rename('MA20'),
+    'BIAS_20': compute_bias_20,
+}
+
+VIEW_INDICATORS = {
+    'hero': ['MFI_14', 'RSI_14', 'BIAS_20'],
+    'kline': ['MA20', 'OBV'],
+    'indicators': ['MACD', 'STOCH'],
+    'report': ['MFI_14', 'MACD'],
+}
+
+@st.cache_resource
+def get_indicator_memo():
+    return {'lock': threading.Lock(), 'entries': OrderedDict()}
+
+def get_indicator(df, ticker, name):
+    last = df.iloc[-1]
+    key = (ticker, df.index[-1], len(df), float(last['Close']), float(last['Volume']), name)
+    memo = get_indicator_memo()
+    with memo['lock']:
+        if key in memo['entries']:
+            memo['entries'].move_to_end(key)
+            return memo['entries'][key]
+
+    try: result = INDICATOR_REGISTRY[name](df, ticker)
+    except: result = None
+
+    with memo['lock']:
+        memo['entries'][key] = result
+        while len(memo['entries']) > INDICATOR_MEMO_SIZE:
+            memo['entries'].popitem(last=False)
+    return result
+
+def get_indicators(df, ticker, names):
+    # Returns a new frame; the shared raw frame from the store is never modified
+    parts = [get_indicator(df, ticker, name) for name in names]
+    parts = [p for p in parts if p is not None]
+    return pd.concat([df, *parts], axis=1) if parts else df
+
+# V17: Live 1m Bars (local tick-to-bar aggregation from Twstock realtime quotes)
+TICK_POLL_SECONDS = 5    # TWSE MIS allows ~3 requests per 5s per IP; one batched request covers every ticker
+TICK_IDLE_SECONDS = 300  # stop polling a ticker nobody has viewed for 5 min
+TW_LOT_SIZE = 1000       # Twstock volume is in lots (張), Yahoo volume is in shares
+
+class TickBarAggregator:
+    def __init__(self, ticker):
+        self.ticker = ticker
+        self.lock = threading.Lock()
+        self.bars = {}  # minute -> [Open, High, Low, Close, Volume]
+        self.last_price = None
+        self.acc_volume = None
+        self.session_date = None
+        self.primed = False
+        self.last_access = time.time()
+
+    def prime(self):
+        # One-shot quote so a freshly opened ticker has a price before the poller's next round
+        with self.lock:
+            if self.primed: return
+            self.primed = True
+        try:
+            quote = call_provider("twstock", ("realtime", self.ticker), lambda: twstock.realtime.get(self.ticker),
+                                  lambda q: q.get('success'), retries=0)
+            if quote and quote['success']: self.on_quote(quote)
+        except:
+            pass
+
+    def on_quote(self, quote):
+        tz = pytz.timezone('Asia/Taipei')
+        minute = pd.Timestamp(datetime.datetime.fromtimestamp(quote['timestamp'], tz)).floor('min')
+        rt = quote['realtime']
+        try: price = float(rt['latest_trade_price'])
+        except (TypeError, ValueError): price = None  # '-' while no trade in this snapshot
+        try: acc_volume = float(rt['accumulate_trade_volume']) * TW_LOT_SIZE
+        except (TypeError, ValueError): acc_volume = None
+
+        with self.lock:
+            if self.session_date != minute.date():
+                # New session: nothing from the previous date (not even its last price) may seed today's bars
+                self.bars = {}
+                self.acc_volume = None
+                self.last_price = None
+                self.session_date = minute.date()
+
+            vol_delta = 0
+            if acc_volume is not None:
+                if self.acc_volume is not None:
+                    vol_delta = max(acc_volume - self.acc_volume, 0)
+                self.acc_volume = acc_volume
+
+            if price is None: price = self.last_price
+            if price is None: return
+
+            bar = self.bars.get(minute)
+            if bar is None:
+                self.bars[minute] = [price, price, price, price, vol_delta]
+            else:
+                bar[1] = max(bar[1], price)
+                bar[2] = min(bar[2], price)
+                bar[3] = price
+                bar[4] += vol_delta
+            self.last_price = price
+
+    def snapshot(self):
+        tz = pytz.timezone('Asia/Taipei')
+        with self.lock:
+            self.last_access = time.time()
+            if self.session_date != datetime.datetime.now(tz).date():
+                # Yesterday's bars and price must never be served as today's session
+                self.bars = {}
+                self.acc_volume = None
+                self.last_price = None
+            live_bars = pd.DataFrame.from_dict(self.bars, orient='index', columns=['Open', 'High', 'Low', 'Close', 'Volume'])
+            return live_bars.sort_index(), self.last_price, self.acc_volume
+
+@st.cache_resource
+def get_tick_registry():
+    return {}, threading.Lock()
+
+def poll_ticks(registry, lock):
+    # twstock exposes no socket timeout, so a hung MIS request keeps its provider worker until the OS gives up;
+    # rounds are skipped while one is still in flight so at most one worker is ever tied up this way
+    tz = pytz.timezone('Asia/Taipei')
+    in_flight = threading.Event()
+
+    def fetch(codes):
+        in_flight.set()
+        try: return twstock.realtime.get(codes)
+        finally: in_flight.clear()
+
+    while True:
+        now = datetime.datetime.now(tz)
+        with lock:
+            for code in [c for c, agg in registry.items() if time.time() - agg.last_access >= TICK_IDLE_SECONDS]:
+                del registry[code]
+            codes = sorted(registry)
+        if codes and not in_flight.is_set() and now.weekday() < 5 and datetime.time(8, 59) <= now.time() <= datetime.time(13, 35):
+            try:
+                quotes = call_provider("twstock", ("realtime", "batch"), lambda: fetch(codes),
+                                       lambda q: q.get('success'), retries=0)
+                if quotes and quotes['success']:
+                    for code in codes:
+                        quote = quotes.get(code)
+                        if quote and quote.get('success'): registry[code].on_quote(quote)
+            except:
+                pass
+        time.sleep(TICK_POLL_SECONDS)
+
+@st.cache_resource
+def start_tick_poller():
+    # One process-wide poller: a single batched MIS request per interval, routed to each ticker's aggregator
+    registry, lock = get_tick_registry()
+    thread = threading.Thread(target=poll_ticks, args=(registry, lock), name="tick-poller", daemon=True)
+    thread.start()
+    return thread
+
+def get_tick_aggregator(ticker):
+    start_tick_poller()
+    registry, lock = get_tick_registry()
+    with lock:
+        agg = registry.get(ticker)
+        if agg is None:
+            agg = TickBarAggregator(ticker)
+            registry[ticker] = agg
+    agg.prime()
+    return agg
+
+def merge_live_bars(df_today, live_bars, acc_volume):
+    merged = df_today.copy()
+    if not live_bars.empty:
+        if merged.empty:
+            merged = live_bars.copy()
+        else:
+            yahoo_last = merged.index[-1]
+            if yahoo_last in live_bars.index:
+                # Yahoo's last bar is usually still forming: widen it with the live ticks
+                live = live_bars.loc[yahoo_last]
+                merged.loc[yahoo_last, 'High'] = max(merged.loc[yahoo_last, 'High'], live['High'])
+                merged.loc[yahoo_last, 'Low'] = min(merged.loc[yahoo_last, 'Low'], live['Low'])
+                merged.loc[yahoo_last, 'Close'] = live['Close']
+                merged.loc[yahoo_last, 'Volume'] = max(merged.loc[yahoo_last, 'Volume'], live['Volume'])
+            merged = pd.concat([merged, live_bars[live_bars.index > yahoo_last]])
+
+        # Minutes without trades become flat zero-volume bars, same as Yahoo
+        full_index = pd.date_range(merged.index[0], merged.index[-1], freq='1min')
+        if len(full_index) > len(merged):
+            merged = merged.reindex(full_index)
+            merged['Close'] = merged['Close'].ffill()
+            for col in ['Open', 'High', 'Low']:
+                merged[col] = merged[col].fillna(merged['Close'])
+            merged['Volume'] = merged['Volume'].fillna(0)
+
+    # Anchor Cum_Vol to the exchange's accumulated volume (covers ticks we missed between polls)
+    if acc_volume is not None and not merged.empty:
+        residual = acc_volume - merged['Volume'].sum()
+        if residual > 0:
+            merged.iloc[-1, merged.columns.get_loc('Volume')] += residual
+    return merged
+
 # V16: Intraday Sniper Data (Hybrid: YFinance History + Twstock Realtime)
-def get_intraday_sniper_data(ticker):
+def get_intraday_sniper_data(ticker, source=None):
     try:
-        # 1. Fetch History from YFinance
-        suffix = get_yfinance_suffix(ticker)
-        stock = yf.Ticker(ticker + suffix)
-        df = stock.history(period="5d", interval="1m")
-        
-        if df.empty and suffix == ".TW":
-             stock = yf.Ticker(ticker + ".TWO")
-             df = stock.history(period="5d", interval="1m")
-        
-        if df.empty: return None, None, None, None
+        # 1. Fetch History from YFinance (or the replay source standing in for it)
+        if source is None:
+            deadline = time.time() + SNIPER_DEADLINE  # one budget for both downloads, not one each
+            symbol, df = fetch_yahoo_history(ticker, "5d", "1m", deadline=deadline)
+        else:
+            df, daily = source.history()
+
+        if df is None or df.empty: return None, None, None, None
 
         # 2. Fetch Base Info (Prev Close & Vol)
-        daily = stock.history(period="5d", interval="1d")
+        if source is None:
+            daily = fetch_symbol_history(symbol, "5d", "1d", deadline=deadline)
+            if daily is None: daily = pd.DataFrame()
         if len(daily) >= 2:
             yesterday_vol = daily['Volume'].iloc[-2]
             prev_close = daily['Close'].iloc[-2]
@@ -234,21 +632,23 @@ def get_intraday_sniper_data(ticker):
         tz = pytz.timezone('Asia/Taipei')
         df.index = df.index.tz_convert(tz)
         
-        # 4. Fetch Realtime Price from Twstock
-        real_price = None
-        try:
-            realtime_data = twstock.realtime.get(ticker)
-            if realtime_data['success']:
-                real_price = float(realtime_data['realtime']['latest_trade_price'])
-        except:
-            pass
+        # 4. Live 1m Bars from the shared tick poller
+        live_bars, real_price, acc_volume = (source or get_tick_aggregator(ticker)).snapshot()
 
         # 5. Hybrid Merge
         latest_date = df.index[-1].date()
-        today_date = datetime.datetime.now(tz).date()
-        
+        today_date = (source.now() if source else datetime.datetime.now(tz)).date()
+
         df_today = df[df.index.date == latest_date].copy()
-        
+
+        if not live_bars.empty and live_bars.index[-1].date() == today_date and latest_date < today_date:
+            # Yahoo has no bars for today yet: the live bars are today's session
+            df_today = df_today.iloc[0:0]
+            latest_date = today_date
+
+        if latest_date == today_date:
+            df_today = merge_live_bars(df_today, live_bars, acc_volume)
+
         if real_price:
             if latest_date == today_date:
                 df_today.iloc[-1, df_today.columns.get_loc('Close')] = real_price
@@ -264,120 +664,482 @@ def get_intraday_sniper_data(ticker):
     except Exception as e:
         return None, None, None, None
 
+# V17: Market Replay (recorded day stands in for yfinance + twstock, on an accelerated clock)
+REPLAY_DIR = "replays"
+
+def record_trading_day(ticker):
+    try:
+        symbol, bars = fetch_yahoo_history(ticker, "5d", "1m")
+        if bars is None: return None
+
+        tz = pytz.timezone('Asia/Taipei')
+        bars.index = bars.index.tz_convert(tz)
+        daily = fetch_symbol_history(symbol, "5d", "1d")
+        if daily is None: daily = pd.DataFrame()
+        replay_date = bars.index[-1].date()
+
+        os.makedirs(REPLAY_DIR, exist_ok=True)
+        path = os.path.join(REPLAY_DIR, f"{ticker}_{replay_date:%Y%m%d}.pkl")
+        pd.to_pickle({'ticker': ticker, 'bars': bars, 'daily': daily}, path)
+        return path
+    except: return None
+
+def list_replay_files():
+    if not os.path.isdir(REPLAY_DIR): return []
+    return sorted(f for f in os.listdir(REPLAY_DIR) if f.endswith(".pkl"))
+
+class ReplaySource:
+    def __init__(self, path, speed):
+        recording = pd.read_pickle(path)
+        self.ticker = recording['ticker']
+        self.bars = recording['bars']
+        replay_date = self.bars.index[-1].date()
+        self.daily = recording['daily'][recording['daily'].index.date <= replay_date]
+        self.session_start = self.bars[self.bars.index.date == replay_date].index[0]
+        self.session_end = self.bars.index[-1] + pd.Timedelta(minutes=1)
+        self.speed = speed
+        self.wall_start = time.time()
+
+    def now(self):
+        elapsed = pd.Timedelta(seconds=(time.time() - self.wall_start) * self.speed).floor('us')
+        return min(self.session_start + elapsed, self.session_end).to_pydatetime()
+
+    def finished(self):
+        return self.now() >= self.session_end
+
+    def history(self):
+        # Like Yahoo, only minutes that have already closed are published
+        minute = pd.Timestamp(self.now()).floor('min')
+        return self.bars[self.bars.index < minute], self.daily
+
+    def snapshot(self):
+        # Same contract as TickBarAggregator.snapshot(): the in-progress minute is the live bar.
+        # It is revealed progressively (Open -> Close by the elapsed fraction of the minute) so the
+        # signal never sees the minute's final close, range or volume before the minute is over.
+        now = pd.Timestamp(self.now())
+        minute = now.floor('min')
+        today = self.bars[(self.bars.index.date == minute.date()) & (self.bars.index <= minute)]
+        closed = today[today.index < minute]
+        live_bars = today[today.index == minute][['Open', 'High', 'Low', 'Close', 'Volume']].astype(float)
+        real_price = float(closed['Close'].iloc[-1]) if not closed.empty else None
+        acc_volume = float(closed['Volume'].sum()) if not today.empty else None
+        if not live_bars.empty:
+            fraction = (now - minute) / pd.Timedelta(minutes=1)
+            bar = live_bars.iloc[-1]
+            real_price = float(bar['Open'] + (bar['Close'] - bar['Open']) * fraction)
+            volume = float(bar['Volume']) * fraction
+            live_bars.iloc[-1] = [bar['Open'], max(bar['Open'], real_price), min(bar['Open'], real_price), real_price, volume]
+            acc_volume += volume
+        return live_bars, real_price, acc_volume
+
+# V17: Multi-Timeframe Bars (resampled locally from the 1m series, no extra provider calls)
+SNIPER_TIMEFRAMES = {"1m": None, "5m": "5min", "15m": "15min", "30m": "30min", "60m": "60min", "1D": "1D"}
+OHLCV_AGG = {'Open': 'first', 'High': 'max', 'Low': 'min', 'Close': 'last', 'Volume': 'sum'}
+
+def resample_ohlcv(df, rule):
+    bars = df[list(OHLCV_AGG)].resample(rule, label='left', closed='left').agg(OHLCV_AGG)
+    return bars.dropna(subset=['Open'])
+
+def get_resampled_bars(df_1m, timeframe, daily=None):
+    rule = SNIPER_TIMEFRAMES.get(timeframe)
+    if rule is None or df_1m is None or df_1m.empty:
+        return df_1m
+
+    # Always from the full 1m frame: merged live bars and late Yahoo fills can revise closed buckets
+    bars = resample_ohlcv(df_1m, rule)
+    if rule == "1D" and daily is not None and not daily.empty:
+        # Today's provisional bar goes on top of the daily history, replacing the provider's row for today
+        history = daily[list(OHLCV_AGG)].copy()
+        tz = df_1m.index.tz
+        history.index = history.index.tz_convert(tz) if history.index.tz is not None else history.index.tz_localize(tz)
+        history = history[history.index.normalize() < bars.index[0]]
+        bars = pd.concat([history, bars])
+    try: bars.ta.bbands(length=20, std=2, append=True)
+    except: pass
+    bars['Cum_Vol'] = bars['Volume'].cumsum()
+    bars['Vol_MA5'] = bars['Volume'].rolling(window=5).mean()
+    return bars
+
+# V16: Sniper Signal Engine (shared by the Sniper view and the JSON API)
+def compute_trailing_stop(curr_price, entry_cost=0):
+    cost_base = entry_cost if entry_cost > 0 else curr_price
+    roi_pct = ((curr_price - cost_base) / cost_base) * 100
+
+    trailing_msg = "蓄力"
+    trailing_sl = cost_base * 0.975
+
+    if roi_pct > 5:
+        trailing_msg = "鎖利"
+        trailing_sl = curr_price * 0.975
+    elif roi_pct > 2:
+        trailing_msg = "保本"
+        trailing_sl = cost_base * 1.005
+    return trailing_msg, float(trailing_sl)
+
+def evaluate_sniper_signal(df_1m, yesterday_vol, prev_close, real_price, now_tw, entry_cost=0):
+    last_bar = df_1m.iloc[-1]
+    curr_price = float(real_price) if real_price else float(last_bar['Close'])
+    is_data_valid = bool(real_price) or df_1m.index[-1].date() == now_tw.date()
+    open_price = float(df_1m.iloc[0]['Open'])
+
+    # --- V16.3 Logic ---
+    trend_pct = ((curr_price - prev_close) / prev_close) * 100
+    body_delta = curr_price - open_price
+    body_len = abs(body_delta)
+    body_pct = (body_delta / prev_close) * 100
+
+    current_high = max(last_bar['High'], curr_price)
+    upper_shadow = current_high - max(open_price, curr_price)
+    shadow_ratio = (upper_shadow / body_len) if body_len > 0.01 else 99.9
+
+    cum_vol = last_bar['Cum_Vol']
+    vol_ratio = (cum_vol / yesterday_vol) * 100 if yesterday_vol > 0 else 0
+
+    current_time = now_tw.time()
+    t_0905 = datetime.time(9, 5)
+    t_0915 = datetime.time(9, 15)
+    t_1000 = datetime.time(10, 0)
+    t_1030 = datetime.time(10, 30)
+
+    cond_vol = False
+    vol_msg = "量縮"
+
+    if current_time < t_0905:
+        cond_vol = False
+        vol_msg = "避險"
+    elif current_time < t_0915:
+        cond_vol = vol_ratio >= 10
+        vol_msg = f"{vol_ratio:.0f}%"
+    elif current_time < t_1000:
+        cond_vol = vol_ratio >= 20
+        vol_msg = f"{vol_ratio:.0f}%"
+    else:
+        cond_vol = vol_ratio >= 30
+        vol_msg = f"{vol_ratio:.0f}%"
+
+    cond_qualify = (curr_price > open_price) and (2 <= trend_pct <= 8) and (body_pct >= 0.2)
+    cond_shadow = shadow_ratio <= 0.5
+    cond_time = current_time <= t_1030
+    final_signal = cond_qualify and cond_shadow and cond_vol and cond_time and is_data_valid
+
+    trailing_msg, trailing_sl = compute_trailing_stop(curr_price, entry_cost)
+
+    return {
+        'curr_price': curr_price, 'open_price': open_price, 'prev_close': float(prev_close),
+        'trend_pct': float(trend_pct), 'body_pct': float(body_pct), 'shadow_ratio': float(shadow_ratio),
+        'cum_vol': float(cum_vol), 'vol_ratio': float(vol_ratio), 'vol_msg': vol_msg,
+        'cond_qualify': bool(cond_qualify), 'cond_shadow': bool(cond_shadow),
+        'cond_vol': bool(cond_vol), 'cond_time': bool(cond_time),
+        'final_signal': bool(final_signal), 'is_data_valid': bool(is_data_valid),
+        'trailing_msg': trailing_msg, 'trailing_sl': trailing_sl,
+    }
+
 def get_company_info_safe(ticker):
     try: 
-        suffix = get_yfinance_suffix(ticker)
-        info = yf.Ticker(ticker + suffix).info
-        if not info or 'trailingPE' not in info:
-             alt_suffix = ".TWO" if suffix == ".TW" else ".TW"
-             alt_info = yf.Ticker(ticker + alt_suffix).info
-             if alt_info and 'trailingPE' in alt_info:
-                 return alt_info
-        return info
+        symbol, info = hedged_yahoo(ticker, ("info",), lambda s: yf.Ticker(s).info,
+                                    lambda i: bool(i) and 'trailingPE' in i)
+        return dict(info) if info else {}
     except: return {} 
 
 def get_financial_data(ticker):
     try:
-        suffix = get_yfinance_suffix(ticker)
-        stock = yf.Ticker(ticker + suffix)
-        if stock.income_stmt is None or stock.income_stmt.empty:
-             alt_suffix = ".TWO" if suffix == ".TW" else ".TW"
-             stock = yf.Ticker(ticker + alt_suffix)
-        return stock.income_stmt, stock.balance_sheet, stock.cashflow
+        def fetch_statements(symbol):
+            stock = yf.Ticker(symbol)
+            return stock.income_stmt, stock.balance_sheet, stock.cashflow
+        symbol, statements = hedged_yahoo(ticker, ("financials",), fetch_statements, lambda f: f is not None and has_rows(f[0]))
+        return statements if statements else (None, None, None)
     except: return None, None, None
 
+# V17: Shared Frame Store (one read-only copy per ticker per process; sessions keep only keys)
+FRAME_STORE_CAP_MB = 256      # global cap across all sessions
+FRAME_TTL_SECONDS = 300       # shared frames are refetched after this
+SESSION_IDLE_SECONDS = 1800   # references from sessions idle this long are dropped
+FRAME_LOCK_STRIPES = 64       # single-flight load locks, striped so they never grow with the ticker count
+FRAME_LOADERS = {
+    'daily': get_technical_data,
+    'info': get_company_info_safe,
+    'financials': get_financial_data,
+}
+
+@st.cache_resource
+def get_frame_store():
+    return {'lock': threading.Lock(), 'entries': OrderedDict(), 'sessions': {},
+            'key_locks': [threading.Lock() for _ in range(FRAME_LOCK_STRIPES)]}
+
+def current_session_id():
+    ctx = get_script_run_ctx()
+    return ctx.session_id if ctx else "headless"
+
+def estimate_bytes(value):
+    if value is None: return 0
+    if isinstance(value, pd.DataFrame): return int(value.memory_usage(deep=True).sum())
+    if isinstance(value, tuple): return sum(estimate_bytes(v) for v in value)
+    try: return len(pickle.dumps(value))
+    except: return sys.getsizeof(value)
+
+def get_shared_frame(kind, ticker):
+    # The returned object is shared by every session on this ticker: read it, never mutate it
+    store = get_frame_store()
+    key = (kind, ticker)
+    session_id = current_session_id()
+
+    def fresh_hit():
+        with store['lock']:
+            store['sessions'][session_id] = time.time()
+            entry = store['entries'].get(key)
+            if entry and time.time() - entry['loaded_at'] < FRAME_TTL_SECONDS:
+                entry['refs'].add(session_id)
+                store['entries'].move_to_end(key)
+                return entry
+        return None
+
+    entry = fresh_hit()
+    if entry: return entry['value']
+    # Single-flight: sessions missing the same key wait for one load instead of each calling the provider
+    with store['key_locks'][hash(key) % FRAME_LOCK_STRIPES]:
+        entry = fresh_hit()
+        if entry: return entry['value']
+        value = FRAME_LOADERS[kind](ticker)
+        if value is None: return None
+
+        with store['lock']:
+            old = store['entries'].pop(key, None)
+            refs = (old['refs'] if old else set()) | {session_id}
+            store['entries'][key] = {'value': value, 'bytes': estimate_bytes(value), 'loaded_at': time.time(), 'refs': refs}
+            evict_frames(store)
+        return value
+
+def release_session_frames(keep_ticker=None):
+    store = get_frame_store()
+    session_id = current_session_id()
+    with store['lock']:
+        for (kind, ticker), entry in store['entries'].items():
+            if ticker != keep_ticker: entry['refs'].discard(session_id)
+
+def invalidate_frames(ticker):
+    store = get_frame_store()
+    with store['lock']:
+        for key in [k for k in store['entries'] if k[1] == ticker]:
+            del store['entries'][key]
+
+def evict_frames(store):
+    # Caller holds store['lock']. LRU order: expired/unreferenced frames go first,
+    # referenced ones only if still over the cap (their sessions simply reload on next access)
+    now = time.time()
+    for session_id, seen in list(store['sessions'].items()):
+        if now - seen > SESSION_IDLE_SECONDS: del store['sessions'][session_id]
+    for entry in store['entries'].values():
+        entry['refs'] &= store['sessions'].keys()
+
+    cap = FRAME_STORE_CAP_MB * 1024 * 1024
+    total = sum(e['bytes'] for e in store['entries'].values())
+    for evict_referenced in (False, True):
+        for key in list(store['entries']):
+            entry = store['entries'][key]
+            expired = now - entry['loaded_at'] >= FRAME_TTL_SECONDS
+            if entry['refs'] and not evict_referenced: continue
+            if total <= cap and not (expired and not entry['refs']): continue
+            total -= entry['bytes']
+            del store['entries'][key]
+
+def frame_store_usage():
+    store = get_frame_store()
+    by_ticker, by_session = {}, {}
+    with store['lock']:
+        for (kind, ticker), entry in store['entries'].items():
+            by_ticker[ticker] = by_ticker.get(ticker, 0) + entry['bytes']
+            for session_id in entry['refs']:
+                by_session[session_id] = by_session.get(session_id, 0) + entry['bytes']
+    return sum(by_ticker.values()), by_ticker, by_session
+
 # --- 4. AI Engine ---
+GEMINI_MIN_INTERVAL = 4.0  # gemini-1.5-flash free tier: 15 requests/min
+
 def get_news_summary(ticker_name):
     if not HAS_SEARCH:
         return "（系統提示：無法搜尋新聞，請確認已安裝 duckduckgo-search）"
-    news_text = ""
-    try:
-        with DDGS() as ddgs:
+    def search():
+        with DDGS(timeout=PROVIDER_TIMEOUT) as ddgs:
             keywords = f"{ticker_name} 新聞"
-            results = ddgs.text(keywords, region='wt-wt', safesearch='off', timelimit='w', max_results=3)
-            if results:
-                for res in results:
-                    news_text += f"- {res['title']}: {res['body']}\n"
-            else:
-                news_text = "（本週無重大新聞）"
-    except Exception as e:
-        news_text = f"（新聞搜尋連線失敗: {str(e)}）"
+            return ddgs.text(keywords, region='wt-wt', safesearch='off', timelimit='w', max_results=3)
+
+    results = call_provider("ddgs", ("news", ticker_name), search, lambda r: bool(r), retries=1)
+    if results is None:
+        return "（新聞搜尋連線失敗，請稍後再試）"
+    if not results:
+        return "（本週無重大新聞）"
+    news_text = ""
+    for res in results:
+        news_text += f"- {res['title']}: {res['body']}\n"
     return news_text
 
+@st.cache_resource
+def get_gemini_throttle():
+    return {'lock': threading.Lock(), 'next_slot': 0.0}
+
+def wait_for_gemini_slot():
+    # Space out Gemini calls across all sessions and batch workers to stay under the RPM quota
+    throttle = get_gemini_throttle()
+    with throttle['lock']:
+        slot = max(time.time(), throttle['next_slot'])
+        throttle['next_slot'] = slot + GEMINI_MIN_INTERVAL
+    time.sleep(max(slot - time.time(), 0))
+
+def compose_sniper_report(ticker_full_name, df, info, financials, api_key, news_content=None, on_progress=None):
+    report_step = on_progress or (lambda pct, msg: None)
+    parts = ticker_full_name.split(" ")
+    code = parts[0]
+    name = parts[1] if len(parts) > 1 else code
+
+    report_step(10, f"🔍 解析 {name} 基礎數據...")
+
+    df = get_indicators(df, code, VIEW_INDICATORS['report'])
+    last = df.iloc[-1]
+    prev = df.iloc[-2]
+    macd_val = last['MACDh_12_26_9'] if 'MACDh_12_26_9' in df.columns else 0
+    
+    tech_data = f"""
+    收盤: {last['Close']:.2f} (漲跌 {last['Close']-prev['Close']:.2f})
+    MFI(14): {last.get('MFI_14', 0):.1f}
+    MACD柱狀圖: {macd_val:.2f}
+    """
+
+    report_step(30, "📊 分析財務報表...")
+    inc_str = "無資料"
+    if financials and financials[0] is not None:
+        inc_df = financials[0].iloc[:, :2] 
+        inc_str = inc_df.to_markdown()
+
+    if news_content is None:
+        report_step(60, f"🌐 搜索 {name} 新聞...")
+        news_content = get_news_summary(name)
+
+    report_step(80, "🤖 Gemini 戰略整合...")
+    wait_for_gemini_slot()
+
+    genai.configure(api_key=api_key)
+    model = genai.GenerativeModel('gemini-1.5-flash') # Force 1.5 Flash for Quota
+
+    prompt = f"""
+    你現在是華爾街頂尖的對沖基金交易員，代號「Sniper」。
+    請針對台股 {name} ({code}) 進行全方位掃描。
+    
+    【輸入數據】
+    技術面：{tech_data}
+    基本面：\n{inc_str}
+    新聞：\n{news_content}
+    PE: {info.get('trailingPE', 'N/A')}
+
+    【任務指令】
+    回覆格式必須嚴格遵守以下結構 (Markdown)：
+    ### 🎯 狙擊報告: {name}
+    **1. 戰情摘要**: (新聞與財報一句話總結)
+    **2. 技術籌碼**: (趨勢與資金流向)
+    ---
+    ### 🔥 最終決策
+    **1. 趨勢評分 (0-10)**: [分數]
+    **2. 資金流向**: [流入/流出/觀望]
+    **3. 操作點位**:
+       * 🔴 壓力: [價格]
+       * 🟢 支撐: [價格]
+       * 💡 策略: [簡短建議]
+    """
+    response = model.generate_content(prompt)
+    return response.text
+
 def generate_sniper_report(ticker_full_name, df, info, financials, api_key):
     if not api_key: return "⚠️ 未設定 API Key"
     progress_bar = st.progress(0)
     status_text = st.empty()
+    def on_progress(pct, msg):
+        status_text.text(msg)
+        progress_bar.progress(pct)
     try:
-        parts = ticker_full_name.split(" ")
-        code = parts[0]
-        name = parts[1] if len(parts) > 1 else code
-        
-        status_text.text(f"🔍 解析 {name} 基礎數據...")
-        progress_bar.progress(10)
-        
-        last = df.iloc[-1]
-        prev = df.iloc[-2]
-        macd_val = last['MACDh_12_26_9'] if 'MACDh_12_26_9' in df.columns else 0
-        
-        tech_data = f"""
-        收盤: {last['Close']:.2f} (漲跌 {last['Close']-prev['Close']:.2f})
-        MFI(14): {last.get('MFI_14', 0):.1f}
-        MACD柱狀圖: {macd_val:.2f}
-        """
-
-        status_text.text("📊 分析財務報表...")
-        progress_bar.progress(30)
-        inc_str = "無資料"
-        if financials and financials[0] is not None:
-            inc_df = financials[0].iloc[:, :2] 
-            inc_str = inc_df.to_markdown()
-
-        status_text.text(f"🌐 搜索 {name} 新聞...")
-        progress_bar.progress(60)
-        news_content = get_news_summary(name)
-
-        status_text.text("🤖 Gemini 戰略整合...")
-        progress_bar.progress(80)
-
-        genai.configure(api_key=api_key)
-        model = genai.GenerativeModel('gemini-1.5-flash') # Force 1.5 Flash for Quota
-
-        prompt = f"""
-        你現在是華爾街頂尖的對沖基金交易員，代號「Sniper」。
-        請針對台股 {name} ({code}) 進行全方位掃描。
-        
-        【輸入數據】
-        技術面：{tech_data}
-        基本面：\n{inc_str}
-        新聞：\n{news_content}
-        PE: {info.get('trailingPE', 'N/A')}
-
-        【任務指令】
-        回覆格式必須嚴格遵守以下結構 (Markdown)：
-        ### 🎯 狙擊報告: {name}
-        **1. 戰情摘要**: (新聞與財報一句話總結)
-        **2. 技術籌碼**: (趨勢與資金流向)
-        ---
-        ### 🔥 最終決策
-        **1. 趨勢評分 (0-10)**: [分數]
-        **2. 資金流向**: [流入/流出/觀望]
-        **3. 操作點位**:
-           * 🔴 壓力: [價格]
-           * 🟢 支撐: [價格]
-           * 💡 策略: [簡短建議]
-        """
-        response = model.generate_content(prompt)
+        report = compose_sniper_report(ticker_full_name, df, info, financials, api_key, on_progress=on_progress)
+        save_batch_report(ticker_full_name.split(" ")[0], report, datetime.datetime.now(pytz.timezone('Asia/Taipei')))
         progress_bar.progress(100)
         status_text.text("✅ 完成！")
         time.sleep(1)
         progress_bar.empty()
         status_text.empty()
-        return response.text
+        return report
     except Exception as e:
         status_text.error(f"分析中斷: {str(e)}")
         return f"❌ 錯誤: {str(e)}"
 
+# V17: Overnight Batch Reports (whole inventory after close, persisted for the morning view)
+REPORT_DIR = "reports"
+BATCH_WORKERS = 3                       # concurrent fetches; Gemini itself is spaced by wait_for_gemini_slot
+BATCH_RUN_AFTER = datetime.time(14, 30)  # after the 13:30 close and Yahoo's daily bar settles
+
+def save_batch_report(code, report, as_of):
+    try:
+        os.makedirs(REPORT_DIR, exist_ok=True)
+        path = os.path.join(REPORT_DIR, f"{code}.json")
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump({'ticker': code, 'report': report, 'as_of': as_of.isoformat()}, f, ensure_ascii=False)
+        os.replace(path + ".tmp", path)
+    except:
+        pass
+
+def load_batch_report(code):
+    try:
+        with open(os.path.join(REPORT_DIR, f"{code}.json"), encoding="utf-8") as f:
+            saved = json.load(f)
+        return saved['report'], datetime.datetime.fromisoformat(saved['as_of'])
+    except:
+        return None, None
+
+def run_batch_reports(api_key):
+    tz = pytz.timezone('Asia/Taipei')
+
+    def build_report(ticker_full_name):
+        code = ticker_full_name.split(" ")[0]
+        name = ticker_full_name.split(" ")[1] if " " in ticker_full_name else code
+        df = get_shared_frame('daily', code)
+        if df is None: return code, False
+        info = get_shared_frame('info', code)
+        financials = get_shared_frame('financials', code)
+        report = compose_sniper_report(ticker_full_name, df, info, financials, api_key, news_content=get_news_summary(name))
+        save_batch_report(code, report, datetime.datetime.now(tz))
+        return code, True
+
+    results = {}
+    tickers = list(dict.fromkeys(get_positions()))  # one fetch per ticker even if listed twice
+    # A restart after the close must not spend quota again on reports already written today
+    cutoff = tz.localize(datetime.datetime.combine(datetime.datetime.now(tz).date(), BATCH_RUN_AFTER))
+    fresh = [t for t in tickers if (load_batch_report(t.split(" ")[0])[1] or cutoff) > cutoff]
+    for t in fresh: results[t.split(" ")[0]] = True
+    tickers = [t for t in tickers if t not in fresh]
+    with ThreadPoolExecutor(max_workers=BATCH_WORKERS) as pool:
+        futures = {pool.submit(build_report, t): t for t in tickers}
+        for future in as_completed(futures):
+            try:
+                code, ok = future.result()
+            except:
+                code, ok = futures[future].split(" ")[0], False
+            results[code] = ok
+    return results
+
+@st.cache_resource
+def start_batch_scheduler(api_key):
+    # One scheduler thread per server process; runs once per trading day after the close.
+    # Streamlit only executes this script for a session, so after a restart it starts with the first page visit.
+    def loop():
+        tz = pytz.timezone('Asia/Taipei')
+        last_run = None
+        while True:
+            now = datetime.datetime.now(tz)
+            if now.weekday() < 5 and now.time() >= BATCH_RUN_AFTER and last_run != now.date():
+                last_run = now.date()
+                try: run_batch_reports(api_key)
+                except: pass
+            time.sleep(60)
+
+    thread = threading.Thread(target=loop, name="batch-reports", daemon=True)
+    thread.start()
+    return thread
+
 # 🔥🔥🔥 V16.5: Unchained AI Expert Prompt 🔥🔥🔥
 def generate_sniper_advice(ticker_name, ticker_code, price, open_price, prev_close, 
                            vol_ratio, shadow_ratio, body_pct, trend_pct, 
@@ -437,11 +1199,110 @@ def generate_sniper_advice(ticker_name, ticker_code, price, open_price, prev_clo
     **4. 一句話點評**: (犀利、直接的總結)
     """
     try:
+        wait_for_gemini_slot()
         response = model.generate_content(prompt)
         return response.text
     except Exception as e: return f"AI 思考中斷: {e}"
 
-# --- 5. Main Logic (Royal UI) ---
+# --- 5. Headless JSON API (bots read signals here instead of scraping the page) ---
+API_PORT = int(os.environ.get("SNIPER_API_PORT", 8502))
+API_SIGNAL_TTL = 10       # seconds; intraday bars are already fed by the shared tick aggregator
+API_INDICATOR_TTL = 300   # seconds; daily indicators only move once a day
+API_NEGATIVE_TTL = 5      # seconds a failed build is remembered, so bots cannot hammer a flapping provider
+API_TICKER_PATTERN = re.compile(r"[0-9A-Z]{4,6}")
+API_CACHE_SIZE = 512      # cached payloads (LRU); two per ticker
+API_LOCK_STRIPES = 64     # single-flight locks are striped so they never grow with the ticker count
+
+@st.cache_resource
+def get_api_cache():
+    return {'lock': threading.Lock(), 'entries': OrderedDict(),
+            'key_locks': [threading.Lock() for _ in range(API_LOCK_STRIPES)]}
+
+def get_api_payload(key, ttl, build):
+    # TTL cache with single-flight: concurrent misses on one key trigger a single provider fetch
+    cache = get_api_cache()
+    entry = cache['entries'].get(key)
+    if entry and entry[0] > time.time(): return entry[1]
+    with cache['key_locks'][hash(key) % API_LOCK_STRIPES]:
+        entry = cache['entries'].get(key)
+        if entry and entry[0] > time.time(): return entry[1]
+        try: payload = build()
+        except: payload = None
+        with cache['lock']:
+            cache['entries'][key] = (time.time() + (ttl if payload is not None else API_NEGATIVE_TTL), payload)
+            cache['entries'].move_to_end(key)
+            while len(cache['entries']) > API_CACHE_SIZE:
+                cache['entries'].popitem(last=False)
+        return payload
+
+def build_indicator_payload(ticker):
+    df = get_shared_frame('daily', ticker)
+    if df is None: return None
+    df = get_indicators(df, ticker, list(INDICATOR_REGISTRY))
+    last = df.iloc[-1]
+    values = {col: (None if pd.isna(last[col]) else float(last[col]))
+              for col in df.columns if col not in ('Dividends', 'Stock Splits')}
+    return {'date': df.index[-1].date().isoformat(), **values}
+
+def build_signal_payload(ticker):
+    df_1m, yesterday_vol, prev_close, real_price = get_intraday_sniper_data(ticker)
+    if df_1m is None or df_1m.empty or prev_close is None: return None
+    now_tw = datetime.datetime.now(pytz.timezone('Asia/Taipei'))
+    signal = evaluate_sniper_signal(df_1m, yesterday_vol, prev_close, real_price, now_tw)
+    # The stop depends on the caller's cost, so it is served per request under 'stop', never cached here
+    signal.pop('trailing_msg', None)
+    signal.pop('trailing_sl', None)
+    signal['bar_time'] = df_1m.index[-1].isoformat()
+    return signal
+
+class SniperApiHandler(BaseHTTPRequestHandler):
+    # GET /api/v1/<ticker>[?cost=<entry cost>]  ->  indicators, V16 signal and trailing stop
+    def do_GET(self):
+        url = urlparse(self.path)
+        parts = [p for p in url.path.split("/") if p]
+        if parts == ["healthz"]:
+            return self.send_json(200, {'ok': True})
+        if len(parts) != 3 or parts[:2] != ["api", "v1"] or not API_TICKER_PATTERN.fullmatch(parts[2]):
+            return self.send_json(404, {'error': 'use /api/v1/<ticker>'})
+
+        ticker = parts[2]
+        if ticker not in twstock.codes:
+            return self.send_json(404, {'error': f'unknown ticker {ticker}'})
+        try: entry_cost = float(parse_qs(url.query).get("cost", ["0"])[0])
+        except ValueError: return self.send_json(400, {'error': 'cost must be a number'})
+        if not math.isfinite(entry_cost) or entry_cost < 0:
+            return self.send_json(400, {'error': 'cost must be a finite, non-negative number'})
+
+        indicators = get_api_payload(("indicators", ticker), API_INDICATOR_TTL, lambda: build_indicator_payload(ticker))
+        signal = get_api_payload(("signal", ticker), API_SIGNAL_TTL, lambda: build_signal_payload(ticker))
+        if indicators is None and signal is None:
+            return self.send_json(404, {'error': f'no data for {ticker}'})
+
+        stop = None
+        if signal:
+            trailing_msg, trailing_sl = compute_trailing_stop(signal['curr_price'], entry_cost)
+            stop = {'entry_cost': entry_cost, 'mode': trailing_msg, 'stop_price': trailing_sl}
+        self.send_json(200, {'ticker': ticker, 'indicators': indicators, 'signal': signal, 'stop': stop})
+
+    def send_json(self, status, body):
+        data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass  # keep the Streamlit console readable under bot traffic
+
+@st.cache_resource
+def start_api_server(port):
+    server = ThreadingHTTPServer(("0.0.0.0", port), SniperApiHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="sniper-api", daemon=True).start()
+    return server
+
+# --- 6. Main Logic (Royal UI) ---
 
 # Top Expander for Settings (Styled)
 with st.expander("⚙️ 皇家設定 (Settings)", expanded=False):
@@ -462,6 +1323,27 @@ with st.expander("⚙️ 皇家設定 (Settings)", expanded=False):
         else:
             gemini_key = st.text_input("API Key", type="password", placeholder="Gemini Key")
 
+    if is_admin():
+        if st.button("⏱️ 分析下一次執行 (Profile rerun)"):
+            st.session_state.profile_requested = True
+            st.rerun()
+
+    if is_admin() and st.checkbox("🧠 記憶體 (Memory)", key="show_memory"):
+        total_bytes, by_ticker, by_session = frame_store_usage()
+        st.caption(f"Shared frames: {total_bytes / 1024**2:.1f} / {FRAME_STORE_CAP_MB} MB · {len(by_session)} sessions")
+        c_mem1, c_mem2 = st.columns(2)
+        with c_mem1:
+            st.dataframe(pd.DataFrame({'MB': {t: b / 1024**2 for t, b in by_ticker.items()}}).round(2), use_container_width=True)
+        with c_mem2:
+            st.dataframe(pd.DataFrame({'MB (shared)': {sid[:8]: b / 1024**2 for sid, b in by_session.items()}}).round(2), use_container_width=True)
+
+# 🌙 Overnight batch reports run server-side, so they only use the secrets key
+if "GEMINI_API_KEY" in st.secrets:
+    start_batch_scheduler(st.secrets["GEMINI_API_KEY"])
+
+try: start_api_server(API_PORT)
+except OSError: pass  # port taken, e.g. by another app.py process that already serves the API
+
 if 'active_ticker' not in st.session_state:
     st.session_state.active_ticker = "2330"
 
@@ -481,6 +1363,7 @@ if app_mode == "📊 庫存 (Inventory)":
     with c_nav_1:
         if st.button("🔄", use_container_width=True):
             st.cache_data.clear()
+            invalidate_frames(st.session_state.get('current_ticker'))
             st.rerun()
     with c_nav_2:
         ticker_list = get_positions()
@@ -518,33 +1401,29 @@ if app_mode == "📊 庫存 (Inventory)":
         if 'current_ticker' not in st.session_state:
             st.session_state.current_ticker = ""
             st.session_state.sniper_report = None
-            st.session_state.df = None
-            st.session_state.info = None
-            st.session_state.financials = None
+            st.session_state.sniper_report_as_of = None
 
         if st.session_state.current_ticker != final_ticker_code:
             st.session_state.current_ticker = final_ticker_code
-            st.session_state.sniper_report = None
-            st.session_state.df = None
-            st.session_state.info = None
-            st.session_state.financials = None
-            
-            with st.spinner('Loading Data...'):
-                st.session_state.df = get_technical_data(final_ticker_code)
-                st.session_state.info = get_company_info_safe(final_ticker_code)
+            st.session_state.sniper_report, st.session_state.sniper_report_as_of = load_batch_report(final_ticker_code)
+            release_session_frames(keep_ticker=final_ticker_code)
+
+        # Session state keeps only current_ticker; the frames live once in the shared store
+        with st.spinner('Loading Data...'):
+            df = get_shared_frame('daily', final_ticker_code)
+            info = get_shared_frame('info', final_ticker_code)
 
         # Hero Style Title
         st.markdown(f"<div style='color:#FFD700; font-size:20px; font-weight:bold; margin-bottom:10px;'>📊 {final_ticker_name}</div>", unsafe_allow_html=True)
 
-        if st.session_state.df is None:
+        if df is None:
             st.error("查無資料")
         else:
-            df = st.session_state.df
-            info = st.session_state.info
-            last = df.iloc[-1]
+            hero_df = get_indicators(df, final_ticker_code, VIEW_INDICATORS['hero'])
+            last = hero_df.iloc[-1]
             
             def safe_num(col): 
-                if col in df.columns and not pd.isna(last[col]): return last[col]
+                if col in hero_df.columns and not pd.isna(last[col]): return last[col]
                 return 0
                 
             close = last['Close']
@@ -587,14 +1466,16 @@ if app_mode == "📊 庫存 (Inventory)":
             </div>
             """, unsafe_allow_html=True)
 
-            tabs = st.tabs(["K線", "指標"])
+            # Only the selected view is rendered, so only its indicators get computed
+            chart_view = st.radio("chart_view", ["K線", "指標"], horizontal=True, key="inventory_view", label_visibility="collapsed")
 
-            with tabs[0]:
+            if chart_view == "K線":
+                view_df = get_indicators(df, final_ticker_code, VIEW_INDICATORS['kline'])
                 fig = make_subplots(rows=2, cols=1, shared_xaxes=True, row_width=[0.2, 0.7], vertical_spacing=0.03)
                 # 👑 Royal Chart Style
-                fig.add_trace(go.Candlestick(x=df.index, open=df['Open'], high=df['High'], low=df['Low'], close=df['Close'], name='K', increasing_line_color='#00E676', decreasing_line_color='#FF5252'), row=1, col=1)
-                fig.add_trace(go.Scatter(x=df.index, y=df['Close'].rolling(20).mean(), line=dict(color='#FFD700', width=1), name='MA20'), row=1, col=1)
-                if 'OBV' in df.columns: fig.add_trace(go.Scatter(x=df.index, y=df['OBV'], name='OBV', line=dict(color='#00E5FF')), row=2, col=1)
+                fig.add_trace(go.Candlestick(x=view_df.index, open=view_df['Open'], high=view_df['High'], low=view_df['Low'], close=view_df['Close'], name='K', increasing_line_color='#00E676', decreasing_line_color='#FF5252'), row=1, col=1)
+                fig.add_trace(go.Scatter(x=view_df.index, y=view_df['MA20'], line=dict(color='#FFD700', width=1), name='MA20'), row=1, col=1)
+                if 'OBV' in view_df.columns: fig.add_trace(go.Scatter(x=view_df.index, y=view_df['OBV'], name='OBV', line=dict(color='#00E5FF')), row=2, col=1)
                 
                 # Update Layout for Royal Theme
                 fig.update_layout(
@@ -609,12 +1490,13 @@ if app_mode == "📊 庫存 (Inventory)":
                 # 🔥 FIX SCROLL TRAP
                 st.plotly_chart(fig, use_container_width=True, config={'scrollZoom': False, 'staticPlot': False})
 
-            with tabs[1]:
+            else:
+                view_df = get_indicators(df, final_ticker_code, VIEW_INDICATORS['indicators'])
                 fig2 = make_subplots(rows=2, cols=1, shared_xaxes=True)
-                if 'MACDh_12_26_9' in df.columns: fig2.add_trace(go.Bar(x=df.index, y=df['MACDh_12_26_9'], marker_color='#29B6F6', name='MACD'), row=1, col=1)
-                if 'STOCHk_9_3_3' in df.columns:
-                    fig2.add_trace(go.Scatter(x=df.index, y=df['STOCHk_9_3_3'], line=dict(color='#FFD700', width=1), name='K'), row=2, col=1)
-                    fig2.add_trace(go.Scatter(x=df.index, y=df['STOCHd_9_3_3'], line=dict(color='#FF5252', width=1), name='D'), row=2, col=1)
+                if 'MACDh_12_26_9' in view_df.columns: fig2.add_trace(go.Bar(x=view_df.index, y=view_df['MACDh_12_26_9'], marker_color='#29B6F6', name='MACD'), row=1, col=1)
+                if 'STOCHk_9_3_3' in view_df.columns:
+                    fig2.add_trace(go.Scatter(x=view_df.index, y=view_df['STOCHk_9_3_3'], line=dict(color='#FFD700', width=1), name='K'), row=2, col=1)
+                    fig2.add_trace(go.Scatter(x=view_df.index, y=view_df['STOCHd_9_3_3'], line=dict(color='#FF5252', width=1), name='D'), row=2, col=1)
                 fig2.update_layout(height=350, template="plotly_dark", paper_bgcolor='rgba(0,0,0,0)', plot_bgcolor='rgba(0,0,0,0)', margin=dict(l=0,r=0,t=10,b=0), showlegend=False)
                 st.plotly_chart(fig2, use_container_width=True, config={'scrollZoom': False})
 
@@ -622,15 +1504,16 @@ if app_mode == "📊 庫存 (Inventory)":
             col_ai_btn, col_ai_res = st.columns([1, 4])
             with col_ai_btn:
                 if st.button("🚀 分析", use_container_width=True):
-                    if st.session_state.financials is None:
-                        with st.spinner("下載財報中..."):
-                            inc, bal, cash = get_financial_data(final_ticker_code)
-                            st.session_state.financials = (inc, bal, cash)
-                    report = generate_sniper_report(final_ticker_name, df, info, st.session_state.financials, gemini_key)
+                    with st.spinner("下載財報中..."):
+                        financials = get_shared_frame('financials', final_ticker_code)
+                    report = generate_sniper_report(final_ticker_name, df, info, financials, gemini_key)
                     st.session_state.sniper_report = report
+                    st.session_state.sniper_report_as_of = datetime.datetime.now(pytz.timezone('Asia/Taipei'))
                     st.rerun()
 
             if st.session_state.sniper_report:
+                if st.session_state.sniper_report_as_of:
+                    st.caption(f"🕒 as of {st.session_state.sniper_report_as_of.strftime('%m/%d %H:%M')}")
                 st.markdown(f"<div class='ai-card'>{st.session_state.sniper_report}</div>", unsafe_allow_html=True)
                 if st.button("🗑️ 清除", key="cls_rpt"):
                     st.session_state.sniper_report = None
@@ -647,13 +1530,19 @@ elif app_mode == "⚡ 狙擊 (Sniper V17)":
         st.session_state.last_refresh = time.time()
         st.rerun()
 
+    if 'replay' not in st.session_state:
+        st.session_state.replay = None
+        st.session_state.replay_stats = None
+    replay = st.session_state.replay
+    frame_start = time.time()
+
     tz = pytz.timezone('Asia/Taipei')
-    now_tw = datetime.datetime.now(tz)
-    
+    now_tw = replay.now() if replay else datetime.datetime.now(tz)
+
     # 👑 Royal Header
     st.markdown(f"""
     <div style="display:flex; justify-content:space-between; align-items:center; margin-bottom:10px;">
-        <span style="color:#FFD700; font-weight:bold; font-size:14px;">⚡ SNIPER V17</span>
+        <span style="color:#FFD700; font-weight:bold; font-size:14px;">⚡ SNIPER V17{' 🎬 REPLAY' if replay else ''}</span>
         <span style="color:#888; font-size:12px;">{now_tw.strftime('%H:%M:%S')}</span>
     </div>
     """, unsafe_allow_html=True)
@@ -669,6 +1558,40 @@ elif app_mode == "⚡ 狙擊 (Sniper V17)":
 
     target_code = sniper_input.strip()
 
+    # 🎬 Market Replay: drive the real pipeline from a recorded day at 1x-100x
+    with st.expander("🎬 回放 (Replay)", expanded=replay is not None):
+        c_rp1, c_rp2 = st.columns([2, 1])
+        with c_rp1:
+            replay_file = st.selectbox("Recording", list_replay_files(), index=None, placeholder="選擇錄製檔", label_visibility="collapsed")
+        with c_rp2:
+            replay_speed = st.slider("Speed", min_value=1, max_value=100, value=10, label_visibility="collapsed")
+
+        c_rp3, c_rp4, c_rp5 = st.columns(3)
+        with c_rp3:
+            if st.button("⏺ 錄製", use_container_width=True):
+                with st.spinner("錄製中..."):
+                    path = record_trading_day(target_code)
+                if path: st.success(f"已儲存 {os.path.basename(path)}")
+                else: st.error("錄製失敗")
+        with c_rp4:
+            if st.button("▶️ 回放", use_container_width=True, disabled=replay_file is None):
+                st.session_state.replay = ReplaySource(os.path.join(REPLAY_DIR, replay_file), replay_speed)
+                st.session_state.replay_stats = {'frames': 0, 'busy': 0.0, 'started': time.time()}
+                st.rerun()
+        with c_rp5:
+            if st.button("⏹ 停止", use_container_width=True, disabled=replay is None):
+                st.session_state.replay = None
+                st.rerun()
+
+        stats = st.session_state.replay_stats
+        if stats and stats['frames']:
+            ups = stats['frames'] / (time.time() - stats['started'])
+            avg_ms = stats['busy'] / stats['frames'] * 1000
+            st.caption(f"⚡ {ups:.1f} updates/s · pipeline {avg_ms:.0f} ms/frame · {stats['frames']} frames")
+
+    if replay:
+        target_code = replay.ticker
+
     if 'last_sniper_code' not in st.session_state:
         st.session_state.last_sniper_code = ""
 
@@ -680,81 +1603,19 @@ elif app_mode == "⚡ 狙擊 (Sniper V17)":
     except: target_name = target_code
     
     # Fetch Data
-    df_1m, yesterday_vol, prev_close, real_price = get_intraday_sniper_data(target_code)
+    df_1m, yesterday_vol, prev_close, real_price = get_intraday_sniper_data(target_code, source=replay)
     
-    # Data Validation
-    is_data_valid = False
     if df_1m is not None and not df_1m.empty and prev_close is not None:
-        latest_data_date = df_1m.index[-1].date()
-        today_date = now_tw.date()
-        
-        if real_price:
-            curr_price = real_price
-            is_data_valid = True
-        else:
-            curr_price = df_1m.iloc[-1]['Close']
-            if latest_data_date == today_date:
-                is_data_valid = True
-            else:
-                st.warning(f"⚠️ 歷史數據: {latest_data_date}")
-    
-    if df_1m is not None and not df_1m.empty and prev_close is not None:
-        last_bar = df_1m.iloc[-1]
-        if not real_price: curr_price = last_bar['Close']
-        open_price = df_1m.iloc[0]['Open']
-        
-        # --- V16.3 Logic ---
-        trend_pct = ((curr_price - prev_close) / prev_close) * 100 
-        body_delta = curr_price - open_price
-        body_len = abs(body_delta)
-        body_pct = (body_delta / prev_close) * 100 
-        
-        current_high = max(last_bar['High'], curr_price)
-        upper_shadow = current_high - max(open_price, curr_price)
-        shadow_ratio = (upper_shadow / body_len) if body_len > 0.01 else 99.9 
-        
-        cum_vol = last_bar['Cum_Vol']
-        vol_ratio = (cum_vol / yesterday_vol) * 100 if yesterday_vol > 0 else 0
-
-        current_time = now_tw.time()
-        t_0905 = datetime.time(9, 5)
-        t_0915 = datetime.time(9, 15)
-        t_1000 = datetime.time(10, 0)
-        t_1030 = datetime.time(10, 30)
-
-        cond_vol = False
-        vol_msg = "量縮"
-        
-        if current_time < t_0905:
-            cond_vol = False
-            vol_msg = "避險"
-        elif current_time < t_0915:
-            cond_vol = vol_ratio >= 10
-            vol_msg = f"{vol_ratio:.0f}%"
-        elif current_time < t_1000:
-            cond_vol = vol_ratio >= 20
-            vol_msg = f"{vol_ratio:.0f}%"
-        else:
-            cond_vol = vol_ratio >= 30
-            vol_msg = f"{vol_ratio:.0f}%"
-            
-        cond_qualify = (curr_price > open_price) and (2 <= trend_pct <= 8) and (body_pct >= 0.2)
-        cond_shadow = shadow_ratio <= 0.5
-        cond_time = current_time <= t_1030
-        final_signal = cond_qualify and cond_shadow and cond_vol and cond_time and is_data_valid
+        sig = evaluate_sniper_signal(df_1m, yesterday_vol, prev_close, real_price, now_tw, entry_cost)
+        if not sig['is_data_valid']:
+            st.warning(f"⚠️ 歷史數據: {df_1m.index[-1].date()}")
 
-        cost_base = entry_cost if entry_cost > 0 else curr_price
-        roi_pct = ((curr_price - cost_base) / cost_base) * 100
-        
-        trailing_msg = "蓄力"
-        trailing_sl = cost_base * 0.975 
-        
-        if roi_pct > 5:
-            trailing_msg = "鎖利"
-            trailing_sl = curr_price * 0.975
-        elif roi_pct > 2:
-            trailing_msg = "保本"
-            trailing_sl = cost_base * 1.005
+        (curr_price, open_price, trend_pct, body_pct, shadow_ratio, cum_vol, vol_ratio,
+         cond_qualify, cond_shadow, cond_vol, vol_msg, cond_time, final_signal, is_data_valid,
+         trailing_msg, trailing_sl) = (sig[k] for k in (
+            'curr_price', 'open_price', 'trend_pct', 'body_pct', 'shadow_ratio', 'cum_vol', 'vol_ratio',
+            'cond_qualify', 'cond_shadow', 'cond_vol', 'vol_msg', 'cond_time', 'final_signal', 'is_data_valid',
+            'trailing_msg', 'trailing_sl'))
 
         # 👑 HERO PRICE SECTION (Royal Style)
         color_cls = "hero-delta-up" if trend_pct > 0 else "hero-delta-down" if trend_pct < 0 else "no-color"
@@ -797,20 +1658,26 @@ elif app_mode == "⚡ 狙擊 (Sniper V17)":
             elif not cond_vol: st.info(f"⏳ 等待補量")
             else: st.info("⏳ 監控中...")
 
-        # Chart
+        # Chart (timeframe toggle, bars resampled from df_1m)
+        chart_tf = st.radio("Timeframe", list(SNIPER_TIMEFRAMES), horizontal=True, key="sniper_tf", label_visibility="collapsed")
+        chart_daily = None
+        if SNIPER_TIMEFRAMES[chart_tf] == "1D":
+            chart_daily = replay.daily if replay else get_shared_frame('daily', target_code)
+        df_chart = get_resampled_bars(df_1m, chart_tf, chart_daily)
+
         fig = make_subplots(rows=2, cols=1, shared_xaxes=True, row_width=[0.2, 0.7], vertical_spacing=0.02)
-        fig.add_trace(go.Candlestick(x=df_1m.index, open=df_1m['Open'], high=df_1m['High'], low=df_1m['Low'], close=df_1m['Close'], name='Price', increasing_line_color='#00E676', decreasing_line_color='#FF5252'), row=1, col=1)
+        fig.add_trace(go.Candlestick(x=df_chart.index, open=df_chart['Open'], high=df_chart['High'], low=df_chart['Low'], close=df_chart['Close'], name='Price', increasing_line_color='#00E676', decreasing_line_color='#FF5252'), row=1, col=1)
         
-        if 'BBU_20_2.0' in df_1m.columns:
-            fig.add_trace(go.Scatter(x=df_1m.index, y=df_1m['BBU_20_2.0'], line=dict(color='#FFD700', width=1), name='Upper'), row=1, col=1)
-            fig.add_trace(go.Scatter(x=df_1m.index, y=df_1m['BBM_20_2.0'], line=dict(color='#FF9100', width=1), name='MA20'), row=1, col=1)
+        if 'BBU_20_2.0' in df_chart.columns:
+            fig.add_trace(go.Scatter(x=df_chart.index, y=df_chart['BBU_20_2.0'], line=dict(color='#FFD700', width=1), name='Upper'), row=1, col=1)
+            fig.add_trace(go.Scatter(x=df_chart.index, y=df_chart['BBM_20_2.0'], line=dict(color='#FF9100', width=1), name='MA20'), row=1, col=1)
         
         if entry_cost > 0:
             fig.add_hline(y=entry_cost, line_dash="dash", line_color="white", row=1, col=1)
             fig.add_hline(y=trailing_sl, line_color="#FF00FF", row=1, col=1)
 
-        colors = ['red' if r['Open'] - r['Close'] >= 0 else 'green' for i, r in df_1m.iterrows()]
-        fig.add_trace(go.Bar(x=df_1m.index, y=df_1m['Volume'], marker_color=colors, name='Vol'), row=2, col=1)
+        colors = ['red' if r['Open'] - r['Close'] >= 0 else 'green' for i, r in df_chart.iterrows()]
+        fig.add_trace(go.Bar(x=df_chart.index, y=df_chart['Volume'], marker_color=colors, name='Vol'), row=2, col=1)
         
         fig.update_layout(
             height=400, 
@@ -856,3 +1723,26 @@ elif app_mode == "⚡ 狙擊 (Sniper V17)":
 
     else:
         st.warning("今日尚未開盤或無資料")
+
+    # 🎬 Replay loop: rerun immediately to measure sustained updates/s
+    if replay:
+        st.session_state.replay_stats['frames'] += 1
+        st.session_state.replay_stats['busy'] += time.time() - frame_start
+        if replay.finished():
+            st.session_state.replay = None
+        st.rerun()
+
+# ⏱️ Per-rerun profile report (only after an admin requested one)
+finish_rerun_profile()
+if st.session_state.get('profile_result'):
+    profile = st.session_state.profile_result
+    with st.expander(f"⏱️ Rerun Profile · {profile['elapsed_ms']:.0f} ms · {profile['samples']} samples", expanded=True):
+        st.dataframe(profile['hot'], use_container_width=True, hide_index=True)
+        c_prof1, c_prof2 = st.columns(2)
+        with c_prof1:
+            st.download_button("⬇️ speedscope", profile['speedscope'], file_name="sniper-rerun.speedscope.json",
+                               mime="application/json", use_container_width=True)
+        with c_prof2:
+            if st.button("🗑️ 清除", key="cls_profile", use_container_width=True):
+                st.session_state.profile_result = None
+                st.rerun()